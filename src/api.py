@@ -6,21 +6,32 @@
 # * PUT is for when we transition to a known state (move to named location, absolute position, etc)
 # * DELETE bye :)
 
-from fastapi import FastAPI, Depends, HTTPException, status, APIRouter
+from fastapi import FastAPI, Body, Depends, HTTPException, status, APIRouter, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.responses import ORJSONResponse
+from starlette.routing import Match
+from pydantic import ValidationError, TypeAdapter
 import uvicorn
 
-import json
-from dataclasses import asdict
-from typing import Optional
+import orjson
+import inspect
+import functools
+from typing import Optional, Any, Annotated
+from urllib.parse import urlsplit, parse_qsl
 
 import secrets
 from settings import (
     Location, 
     get_state, 
-    save_state, 
+    set_position,
+    set_location,
+    remove_location,
     log_config,
-    get_config
+    get_config,
+    get_auth_digest,
+    make_session_token,
+    valid_session_token,
+    credentials_digest
 )
 import logging
 from pydantic import BaseModel
@@ -43,47 +54,82 @@ from constants import (
     APP_NAME,
 )
 from mqtt import ha_reregister_event
-import threading
 
 
+SESSION_COOKIE = "pitilt_sess"
+
 FIELD_STATUS = "status"
 VALUE_OK     = "ok"
 STATUS_GOOD = {FIELD_STATUS: VALUE_OK}
+STATUS_GOOD_JSON = orjson.dumps(STATUS_GOOD)
 
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix=f"/api/{API_VERSION}")
-app = FastAPI()
-security = HTTPBasic()
+app = FastAPI(default_response_class=ORJSONResponse)
+# missing BasicAuth is allowed through so a session cookie can be used instead
+security = HTTPBasic(auto_error=False)
+
+# serialized GET /locations response as (state, bytes), rebuilt on next read
+# after any save or if the state was reloaded from the database
+locations_json_cache: tuple | None = None
+
+# uvicorn server created by start_api, kept so stop_api can stop it
+server: uvicorn.Server = None
+
+
+
 
-api_shutdown_event = threading.Event()
+class BatchRequestItem(BaseModel):
+    id: str
+    url: str
+    method: str
+    body: Optional[dict[str, Any]] = None
 
 
+class BatchRequest(BaseModel):
+    requests: list[BatchRequestItem]
 
 
-class Value(BaseModel):
-    value: int | float
+def status_good():
+    # body is serialized once at import, but FastAPI attaches per-request
+    # background tasks to the returned Response so it can't be shared
+    return Response(STATUS_GOOD_JSON, media_type="application/json")
 
+def update_ha():
+    global locations_json_cache
+    locations_json_cache = None
 
-def save_state_and_update_ha():
-    save_state()
-        
     # re-register in home assistant (for new locations)
     ha_reregister_event.set()
-    
 
+def basic_login(credentials: Optional[HTTPBasicCredentials]):
+    # single constant time compare against the digest computed at config load
+    if credentials and secrets.compare_digest(
+        credentials_digest(credentials.username, credentials.password),
+        get_auth_digest()
+    ):
+        return credentials.username
+
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Incorrect username or password",
+        headers={"WWW-Authenticate": "Basic"},
+    )
+
+async def require_basic_login(credentials: Optional[HTTPBasicCredentials] = Depends(security)):
+    return basic_login(credentials)
 
-def require_login(credentials: HTTPBasicCredentials = Depends(security)):
+async def require_login(
+    request: Request,
+    credentials: Optional[HTTPBasicCredentials] = Depends(security)
+):
+    # signed, timestamped session cookie from /login
+    session = request.cookies.get(SESSION_COOKIE)
+    if session and valid_session_token(session):
+        return get_config().pitilt.username
 
-    correct_username = secrets.compare_digest(credentials.username, get_config().pitilt.username)
-    correct_password = secrets.compare_digest(credentials.password, get_config().pitilt.password)
-    if not (correct_username and correct_password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return credentials.username
+    return basic_login(credentials)
 
 
 
@@ -93,19 +139,49 @@ def require_login(credentials: HTTPBasicCredentials = Depends(security)):
 #
 
 @app.get("/")
-def root():
+async def root():
     return {APP_NAME: VERSION}
 
+# exchange BasicAuth for a session cookie so repeated calls (UI jog) skip it.
+# BasicAuth only - a session can't be used to extend itself
+@router.post("/login", name="login")
+async def login(response: Response, _=Depends(require_basic_login)):
+    response.set_cookie(
+        SESSION_COOKIE,
+        make_session_token(),
+        max_age=get_config().pitilt.session_max_age,
+        httponly=True,
+        samesite="strict"
+    )
+    return STATUS_GOOD
+
+@router.post("/logout", name="logout")
+async def logout(response: Response):
+    response.delete_cookie(SESSION_COOKIE, httponly=True, samesite="strict")
+    return STATUS_GOOD
+
+def get_locations_json():
+    global locations_json_cache
+    state = get_state()
+    if locations_json_cache is None or locations_json_cache[0] is not state:
+        # orjson serializes the Location dataclasses natively
+        locations_json_cache = (state, orjson.dumps(state.locations))
+    return locations_json_cache[1]
+
 @router.get("/locations")
-def list_locations(_=Depends(require_login)):
-    return json.dumps(asdict(get_state().locations), indent=2)
+async def list_locations(pretty: bool = False, _=Depends(require_login)):
+    if pretty:
+        # indentation is display only, so build it on demand instead of caching
+        locations = orjson.dumps(get_state().locations, option=orjson.OPT_INDENT_2)
+        return Response(locations, media_type="application/json")
+    return Response(get_locations_json(), media_type="application/json")
 
 @router.get("/pan")
-def get_pan(_=Depends(require_login)):
+async def get_pan(_=Depends(require_login)):
     return {pan: get_current_tilt_position()}
 
 @router.get("/tilt")
-def get_tilt(_=Depends(require_login)):
+async def get_tilt(_=Depends(require_login)):
     return {tilt: get_current_tilt_position()}
 
 
@@ -114,106 +190,128 @@ def get_tilt(_=Depends(require_login)):
 #
 
 @router.put("/locations/{name}")
-def api_move_location(name, _=Depends(require_login)):
-    move_location(name)
-    return STATUS_GOOD
+async def api_move_location(name, _=Depends(require_login)):
+    return move_location(name)
 
 @router.post("/locations/{name}")
-def save_location(name, _=Depends(require_login)):
-    get_state().locations[name] = Location(
+async def save_location(name, _=Depends(require_login)):
+    set_location(name, Location(
         pan=get_current_pan_position(),
         tilt=get_current_tilt_position()
-    )
-    save_state_and_update_ha()
-    return STATUS_GOOD
+    ))
+    update_ha()
+    return status_good()
 
 @router.delete("/locations/{name}")
-def delete_location(name, _=Depends(require_login)):
-    del get_state().locations[name]
-    save_state_and_update_ha()
-    return STATUS_GOOD
+async def delete_location(name, _=Depends(require_login)):
+    remove_location(name)
+    update_ha()
+    return status_good()
 
 #
 # API - Axis limits and settings
 #
 @router.put("/tilt/sleep")
-def tilt_sleep(value: Value, _=Depends(require_login)):
-    get_state().position.tilt.sleep = value.value
+async def tilt_sleep(value: float = Body(embed=True), _=Depends(require_login)):
+    set_position("tilt", "sleep", value)
 
-    save_state_and_update_ha()
-    return STATUS_GOOD
+    update_ha()
+    return status_good()
 
 @router.put("/tilt/step")
-def tilt_step(value: Value, _=Depends(require_login)):
-    get_state().position.tilt.step = value.value
+async def tilt_step(value: int = Body(embed=True, gt=0), _=Depends(require_login)):
+    set_position("tilt", "step", value)
 
-    save_state_and_update_ha()
-    return STATUS_GOOD
+    update_ha()
+    return status_good()
 
-@router.put("/tilt/max")
-def tilt_max(value: Optional[Value] = None, _=Depends(require_login)):
-    if value and value.value:
-        get_state().position.tilt.max = value.value
-    else:
-        get_state().position.tilt.max = get_current_tilt_position()
+@router.put("/tilt/max/current")
+async def tilt_max_current(_=Depends(require_login)):
+    set_position("tilt", "max", get_current_tilt_position())
+    update_ha()
+    return status_good()
 
-    save_state_and_update_ha()
-    return STATUS_GOOD
+@router.put("/tilt/max")
+async def tilt_max(value: Optional[int] = Body(None, embed=True), _=Depends(require_login)):
+    if value is None:
+        # deprecated: PUT /tilt/max/current
+        return await tilt_max_current(_)
+    set_position("tilt", "max", value)
+    update_ha()
+    return status_good()
+
+@router.put("/tilt/min/current")
+async def tilt_min_current(_=Depends(require_login)):
+    set_position("tilt", "min", get_current_tilt_position())
+    update_ha()
+    return status_good()
 
 @router.put("/tilt/min")
-def tilt_min(value: Optional[Value] = None, _=Depends(require_login)):
-    if value and value.value:
-        get_state().position.tilt.min = value.value
-    else:
-        get_state().position.tilt.min = get_current_tilt_position()
-    save_state_and_update_ha()
-    return STATUS_GOOD
+async def tilt_min(value: Optional[int] = Body(None, embed=True), _=Depends(require_login)):
+    if value is None:
+        # deprecated: PUT /tilt/min/current
+        return await tilt_min_current(_)
+    set_position("tilt", "min", value)
+    update_ha()
+    return status_good()
 
 @router.put("/pan/sleep")
-def pan_sleep(value: Value, _=Depends(require_login)):
-    get_state().position.pan.sleep = value.value
+async def pan_sleep(value: float = Body(embed=True), _=Depends(require_login)):
+    set_position("pan", "sleep", value)
 
-    save_state_and_update_ha()
-    return STATUS_GOOD
+    update_ha()
+    return status_good()
 
 @router.put("/pan/step")
-def pan_step(value: Value, _=Depends(require_login)):
-    get_state().position.pan.step = value.value
+async def pan_step(value: int = Body(embed=True, gt=0), _=Depends(require_login)):
+    set_position("pan", "step", value)
 
-    save_state_and_update_ha()
-    return STATUS_GOOD
+    update_ha()
+    return status_good()
+
+@router.put("/pan/max/current")
+async def pan_max_current(_=Depends(require_login)):
+    set_position("pan", "max", get_current_pan_position())
+    update_ha()
+    return status_good()
 
 @router.put("/pan/max")
-def pan_max(value: Optional[Value] = None, _=Depends(require_login)):
-    if value and value.value:
-        get_state().position.pan.max = value.value
-    else:
-        get_state().position.pan.max = get_current_pan_position()
-    save_state_and_update_ha()
-    return STATUS_GOOD
+async def pan_max(value: Optional[int] = Body(None, embed=True), _=Depends(require_login)):
+    if value is None:
+        # deprecated: PUT /pan/max/current
+        return await pan_max_current(_)
+    set_position("pan", "max", value)
+    update_ha()
+    return status_good()
+
+@router.put("/pan/min/current")
+async def pan_min_current(_=Depends(require_login)):
+    set_position("pan", "min", get_current_pan_position())
+    update_ha()
+    return status_good()
 
 @router.put("/pan/min")
-def pan_min(value: Optional[Value] = None, _=Depends(require_login)):
-    if value and value.value:
-        get_state().position.pan.min = value.value
-    else:
-        get_state().position.pan.min = get_current_pan_position()
-    save_state_and_update_ha()
-    return STATUS_GOOD
+async def pan_min(value: Optional[int] = Body(None, embed=True), _=Depends(require_login)):
+    if value is None:
+        # deprecated: PUT /pan/min/current
+        return await pan_min_current(_)
+    set_position("pan", "min", value)
+    update_ha()
+    return status_good()
 
 #
 # API - Absolute move axis
 #
 
 @router.put("/pan")
-def api_pan(value: Value, relative=False):
-    pan(value.value, relative)
-    return STATUS_GOOD
+async def api_pan(value: int = Body(embed=True), relative=False):
+    want, job_id = pan(value, relative)
+    return {**STATUS_GOOD, "pan": want, "job": job_id}
 
 @router.put("/tilt")
-def api_tilt(value: Value, relative=False):
-    tilt(value.value, relative)
-    return STATUS_GOOD
+async def api_tilt(value: int = Body(embed=True), relative=False):
+    want, job_id = tilt(value, relative)
+    return {**STATUS_GOOD, "tilt": want, "job": job_id}
 
 #
 # API - Relative move axis
@@ -221,36 +319,133 @@ def api_tilt(value: Value, relative=False):
 
 # tilt is inverted
 @router.post("/down")
-def api_move_down(_=Depends(require_login)):
-    return {**STATUS_GOOD, "tilt": move_down()}
+async def api_move_down(_=Depends(require_login)):
+    want, job_id = move_down()
+    return {**STATUS_GOOD, "tilt": want, "job": job_id}
 
 
 @router.post("/up")
-def api_move_up(_=Depends(require_login)):
-    return {**STATUS_GOOD, "tilt": move_up()}
+async def api_move_up(_=Depends(require_login)):
+    want, job_id = move_up()
+    return {**STATUS_GOOD, "tilt": want, "job": job_id}
 
 
 @router.post("/left")
-def api_move_left(_=Depends(require_login)):
-    return {**STATUS_GOOD, "pan": move_left()}
+async def api_move_left(_=Depends(require_login)):
+    want, job_id = move_left()
+    return {**STATUS_GOOD, "pan": want, "job": job_id}
 
 
 @router.post("/right")
-def api_move_right(_=Depends(require_login)):
-    return {**STATUS_GOOD, "pan": move_right()}
+async def api_move_right(_=Depends(require_login)):
+    want, job_id = move_right()
+    return {**STATUS_GOOD, "pan": want, "job": job_id}
+
+#
+# API - Batch
+#
+
+# batch itself (recursion) and login/logout (need the real Response for the cookie)
+BATCH_EXCLUDED_ROUTES = {"batch", "login", "logout"}
+
+# building a pydantic adapter is expensive - one per annotation is plenty
+@functools.cache
+def get_type_adapter(annotation):
+    return TypeAdapter(annotation)
+
+# Dispatch several sub-requests in one round-trip, eg a UI jog:
+# {"requests": [{"id": "1", "url": "/up", "method": "POST"}, ...]}
+# urls are relative to the API prefix. Sub-requests are run in order (relative
+# moves stack) and share the batch's login
+async def dispatch_batch_item(item: BatchRequestItem, username):
+    split = urlsplit(item.url)
+    path = split.path
+    if not path.startswith(router.prefix):
+        path = router.prefix + path
+
+    scope = {"type": "http", "path": path, "method": item.method.upper()}
+    path_matched = False
+    for route in router.routes:
+        if route.name in BATCH_EXCLUDED_ROUTES:
+            continue
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            break
+        # PARTIAL - right path, wrong method
+        path_matched = path_matched or match == Match.PARTIAL
+    else:
+        if path_matched:
+            return status.HTTP_405_METHOD_NOT_ALLOWED, {"detail": "Method Not Allowed"}
+        return status.HTTP_404_NOT_FOUND, {"detail": "Not Found"}
+
+    params = inspect.signature(route.endpoint).parameters
+    kwargs = {**child_scope["path_params"]}
+    for k, v in parse_qsl(split.query):
+        if k not in params:
+            continue
+        # convert like FastAPI would, eg pretty=false -> False
+        annotation = params[k].annotation
+        if annotation is not inspect.Parameter.empty:
+            v = get_type_adapter(annotation).validate_python(v)
+        kwargs[k] = v
+    if "_" in params:
+        kwargs["_"] = username
+    if "value" in params:
+        # handlers are called directly, so resolve the Body(embed=True) default here
+        body_field = params["value"].default
+        if item.body is not None and "value" in item.body:
+            # with the Body constraints, eg step gt=0
+            annotation = params["value"].annotation
+            if body_field.metadata:
+                annotation = Annotated[(annotation, *body_field.metadata)]
+            kwargs["value"] = get_type_adapter(annotation).validate_python(item.body["value"])
+        elif body_field.is_required():
+            return status.HTTP_422_UNPROCESSABLE_ENTITY, {"detail": "body required"}
+        else:
+            kwargs["value"] = body_field.default
+
+    result = route.endpoint(**kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+    if isinstance(result, Response):
+        # pre-serialized response (eg cached /locations)
+        return result.status_code, orjson.loads(result.body)
+    return status.HTTP_200_OK, result
+
+@router.post("/batch", name="batch")
+async def batch(batch_request: BatchRequest, username=Depends(require_login)):
+    responses = []
+    for item in batch_request.requests:
+        try:
+            status_code, body = await dispatch_batch_item(item, username)
+        except HTTPException as e:
+            status_code, body = e.status_code, {"detail": e.detail}
+        except ValidationError as e:
+            status_code, body = status.HTTP_422_UNPROCESSABLE_ENTITY, {"detail": e.errors()}
+        except Exception:
+            logger.exception(f"batch request {item.id} failed")
+            status_code, body = status.HTTP_500_INTERNAL_SERVER_ERROR, {"detail": "Internal Server Error"}
+        responses.append({"id": item.id, "status": status_code, "body": body})
+
+    return {"responses": responses}
 
 
 app.include_router(router)
 
 def start_api():
-    uvicorn.run(
+    global server
+    server = uvicorn.Server(uvicorn.Config(
         app, 
         host=get_config().pitilt.host,
         port=get_config().pitilt.port,    
+        # C event loop/HTTP parser instead of pure python asyncio/h11
+        loop="uvloop",
+        http="httptools",
         log_config=log_config,
         log_level=get_config().pitilt.uvicorn_log_level
-    )
+    ))
+    server.run()
 
-def shutdown_thread(msg):
-    logger.error(msg)
-    api_shutdown_event.set()
\ No newline at end of file
+def stop_api():
+    if server:
+        server.should_exit = True
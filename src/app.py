@@ -1,46 +1,66 @@
 import threading
+import signal
 from control import home_servos
-from mqtt import start_mqtt, mqtt_shutdown_event
-from settings import setup, log_config
+from mqtt import start_mqtt, stop_mqtt
+from settings import setup, flush_state, get_config, shutdown_event, shutdown_thread
 import logging
-from api import start_api, api_shutdown_event
-import time
+from api import start_api, stop_api
 import sys
 
 
 logger = logging.getLogger(__name__)
 
+# threads get this long each to finish once shutdown starts
+THREAD_JOIN_TIMEOUT = 5
+
+# sys.exit() status - stays an error unless we were asked to stop by a signal,
+# so systemd restarts us when a thread fails
+exit_status = "shutting down system"
+
+def handle_signal(signum, frame):
+    global exit_status
+    logger.info(f"received {signal.Signals(signum).name}")
+    exit_status = 0
+    shutdown_event.set()
+
+def run_thread(name, target):
+    """run target and request shutdown if it dies - returning is fine (eg MQTT disabled)"""
+    try:
+        target()
+    except Exception:
+        logger.exception(f"{name} thread crashed")
+        shutdown_thread(f"{name} thread crashed")
+    except SystemExit as e:
+        # eg uvicorn failing to bind its port
+        shutdown_thread(f"{name} thread exited: {e.code}")
+    else:
+        logger.info(f"{name} thread finished")
+
 
 if __name__ == "__main__":
     setup()
-    log_config = log_config
-    logger.debug("Debug mode enabled")
+    if get_config().pitilt.debug:
+        logger.debug("Debug mode enabled")
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
 
     home_servos()
     
-    api_thread = threading.Thread(target=start_api, daemon=True)
-    mqtt_thread = threading.Thread(target=start_mqtt, daemon=True)
+    api_thread = threading.Thread(target=run_thread, args=("API", start_api), daemon=True)
+    mqtt_thread = threading.Thread(target=run_thread, args=("MQTT", start_mqtt), daemon=True)
     
     api_thread.start()
     mqtt_thread.start()
 
     # wait for shutdown signal from threads
-    shutdown = False
-    while not shutdown:
-        if mqtt_shutdown_event.is_set():
-            logger.error("MQTT thread requested shutdown - triggering exit")
-            shutdown = True
-        if api_shutdown_event.is_set():
-            logger.error("API thread requested shutdown - triggering exit")
-            shutdown = True
-
-        time.sleep(0.1)
-
-    sys.exit("shutting down system")
-
-    
+    shutdown_event.wait()
+    logger.info("shutdown requested - stopping threads")
 
-    # keep main thread alive
-    mqtt_thread.join()
-    api_thread.join()    
+    stop_mqtt()
+    stop_api()
+    mqtt_thread.join(timeout=THREAD_JOIN_TIMEOUT)
+    api_thread.join(timeout=THREAD_JOIN_TIMEOUT)
 
+    flush_state()
+    sys.exit(exit_status)
@@ -3,7 +3,12 @@ API_VERSION = "v1"
 LOG_CONFIG  = f"/etc/{APP_NAME}/log_config.json"
 DEFAULT_CONFIG_FILE = f"/etc/{APP_NAME}/{APP_NAME}_config.yaml"
 DEFAULT_STATE_FILE  = f"/var/lib/{APP_NAME}/{APP_NAME}_state.json"
+DEFAULT_STATE_DB    = f"/var/lib/{APP_NAME}/{APP_NAME}_state.sqlite"
 DEFAULT_SERVO_STEP  = 1
 DEFAULT_SERVO_SLEEP = 0.025
+# moves of this many degrees or less jump straight to the target (eg UI jog)
+MIN_STEP_SWEEP = 5
+# coalesce bursts of state changes (eg settings sliders) into one write
+SAVE_STATE_DEBOUNCE = 0.2
 AUTH_METHOD_MTLS = "mtls"
 AUTH_METHOD_PASSWORD = "password"
@@ -1,10 +1,14 @@
 import logging
 import time
+import queue
+import threading
+import itertools
 import board
 import busio
 from adafruit_pca9685 import PCA9685
 from adafruit_motor import servo
 from settings import get_state
+from constants import MIN_STEP_SWEEP
 
 logger = logging.getLogger(__name__)
 
@@ -21,38 +25,51 @@ servo_pan = servo.Servo(pca.channels[0])
 # Servo on channel 1
 servo_tilt = servo.Servo(pca.channels[1])
 
+# moves are executed by a single worker thread so callers (API/MQTT) return
+# immediately instead of sleeping through the whole sweep. Each job is
+# (job_id, servo, schedule, sleep)
+move_queue = queue.Queue()
+move_job_ids = itertools.count(1)
+move_lock = threading.Lock()
+
+# where each servo will end up once all queued jobs have run - relative moves
+# must be computed from here, not from the servo which may still be moving
+servo_targets = {}
+
 def get_angle_as_int(servo):
     return int(round(servo.angle))
 
+def get_target_as_int(servo):
+    if servo in servo_targets:
+        return servo_targets[servo]
+    return get_angle_as_int(servo)
+
 def clamp(val, min_val, max_val):
     return max(min_val, min(val, max_val))
 
 def pan(i: int, relative):
-    current = get_angle_as_int(servo_pan)
-    want = clamp(
-        i + (current if relative else 0), 
-        get_state().position.pan.min,
-        get_state().position.pan.max
-    )
-    logger.debug(f"pan {i} degrees - {current} -> {want} degrees")
-    move_servo(servo_pan, get_state().position.pan.step, get_state().position.pan.sleep, want)
-    return want
+    position = get_state().position.pan
+    with move_lock:
+        current = get_target_as_int(servo_pan)
+        want = clamp(i + (current if relative else 0), position.min, position.max)
+        logger.debug(f"pan {i} degrees - {current} -> {want} degrees")
+        job_id = move_servo(servo_pan, position.step, position.sleep, want)
+    return want, job_id
 
 def tilt(i: int, relative):
-    current = get_angle_as_int(servo_tilt)
-    want = clamp(
-        i + (current if relative else 0), 
-        get_state().position.tilt.min,
-        get_state().position.tilt.max
-    )
-    logger.debug(f"tilt {i} degrees - {current} -> {want} degrees")
-    move_servo(servo_tilt, get_state().position.tilt.step, get_state().position.tilt.sleep, want)
-    return want
+    position = get_state().position.tilt
+    with move_lock:
+        current = get_target_as_int(servo_tilt)
+        want = clamp(i + (current if relative else 0), position.min, position.max)
+        logger.debug(f"tilt {i} degrees - {current} -> {want} degrees")
+        job_id = move_servo(servo_tilt, position.step, position.sleep, want)
+    return want, job_id
 
 
 def move_servo(servo, step: int, sleep: float, want: int):
-    current = get_angle_as_int(servo)
-    if want > servo.angle:
+    """queue a move of servo to want, returns the job id"""
+    current = get_target_as_int(servo)
+    if want > current:
         direction = +1
     else:
         direction = -1
@@ -65,66 +82,98 @@ def move_servo(servo, step: int, sleep: float, want: int):
     # will prevent very small changes in want from working as in this example we might be
     # moving to 10 which the servo is basically already at - so we get a twitch or nothing
     # for this reason, move the servo by 2 degrees+ each time 
-    for i in range(max(0, current), want + direction, step * direction):
-        logger.debug(f"servo.angle set: {i}")
-        servo.angle = i
-        time.sleep(sleep)
+    if abs(want - current) <= MIN_STEP_SWEEP:
+        # short move, one write and nothing to pace
+        schedule = (want,)
+        sleep = 0
+    else:
+        schedule = list(range(max(0, current), want + direction, step * direction))
+        if schedule[-1] != want:
+            # step doesn't divide the move evenly - finish on want, otherwise
+            # the target we record drifts from where the servo really is
+            schedule.append(want)
+
+    job_id = next(move_job_ids)
+    servo_targets[servo] = want
+    move_queue.put((job_id, servo, schedule, sleep))
+    return job_id
+
+def move_worker():
+    while True:
+        job_id, servo, schedule, sleep = move_queue.get()
+        logger.debug(f"move job {job_id} started: {schedule[0]} -> {schedule[-1]} in {len(schedule)} steps")
+        try:
+            # write only - no servo.angle reads or per-step logging in here
+            for i in schedule:
+                servo.angle = i
+                time.sleep(sleep)
+        except Exception as e:
+            logger.error(f"move job {job_id} failed: {e}")
+        finally:
+            move_queue.task_done()
+
+def start_move_worker():
+    threading.Thread(target=move_worker, daemon=True).start()
 
 def move_location(name):
-    if not name in get_state().locations:
+    state = get_state()
+    location = state.locations.get(name)
+    if not location:
         logger.debug(f"requested invalid location: {name}")
         return {"status": "not found"}
-    
-    want_pan = clamp(
-        get_state().locations[name].pan, 
-        get_state().position.pan.min, 
-        get_state().position.pan.max
-    ) 
-    
-    want_tilt = clamp(
-        get_state().locations[name].tilt, 
-        get_state().position.tilt.min, 
-        get_state().position.tilt.max
-    ) 
+
+    pan_position = state.position.pan
+    tilt_position = state.position.tilt
+    want_pan = clamp(location.pan, pan_position.min, pan_position.max)
+    want_tilt = clamp(location.tilt, tilt_position.min, tilt_position.max)
 
     logger.info(f"move to location={name} | pan={want_pan} tilt={want_tilt}")
 
-    move_servo(servo_pan, get_state().position.pan.step, get_state().position.pan.sleep, want_pan)
-    move_servo(servo_tilt, get_state().position.tilt.step, get_state().position.tilt.sleep, want_tilt)
+    with move_lock:
+        move_servo(servo_pan, pan_position.step, pan_position.sleep, want_pan)
+        job_id = move_servo(servo_tilt, tilt_position.step, tilt_position.sleep, want_tilt)
+    return {"status": "ok", "job": job_id}
 
 
+# where the servo is going - moves are queued, so reading the servo itself would
+# give a position part way through (or before) the sweep
 def get_current_tilt_position():
-    return get_angle_as_int(servo_tilt)
+    with move_lock:
+        return get_target_as_int(servo_tilt)
 
 def get_current_pan_position():
-    return get_angle_as_int(servo_pan)
+    with move_lock:
+        return get_target_as_int(servo_pan)
 
 def home_servos():
-    servo_pan.actuation_range = get_state().position.pan.max
-    servo_tilt.actuation_range = get_state().position.tilt.max
+    start_move_worker()
+    state = get_state()
+    servo_pan.actuation_range = state.position.pan.max
+    servo_tilt.actuation_range = state.position.tilt.max
     if servo_pan.angle == None:
         # after power off, angle state is lost
         logger.info("init servo_pan angle")
-        servo_pan.angle = get_state().locations["home"].pan
+        servo_pan.angle = state.locations["home"].pan
 
     if servo_tilt.angle == None:
         logger.info("init servo_tilt angle")
-        servo_tilt.angle = get_state().locations["home"].tilt
+        servo_tilt.angle = state.locations["home"].tilt
+
+    # read the servos once here, from now on moves start from the queued target
+    with move_lock:
+        servo_targets[servo_pan] = get_angle_as_int(servo_pan)
+        servo_targets[servo_tilt] = get_angle_as_int(servo_tilt)
 
     move_location("home")    
 
 def move_down():
-    want = tilt(+2, True)
-    return want
+    return tilt(+2, True)
 
 def move_up():
-    want = tilt(-2, True)
-    return want
+    return tilt(-2, True)
 
 def move_left():
-    want = pan(+2, True)
-    return want
+    return pan(+2, True)
 
 def move_right():
-    want = pan(-2, True)
-    return want
+    return pan(-2, True)
@@ -4,7 +4,7 @@ from paho.mqtt.properties import Properties
 from paho.mqtt.packettypes import PacketTypes 
 import logging
 import ssl
-from settings import get_config, get_state
+from settings import get_config, get_state, shutdown_event, shutdown_thread
 from constants import (
     APP_NAME,
     API_VERSION,
@@ -14,7 +14,7 @@ from constants import (
 from version import VERSION
 import time
 from pathlib import Path
-import json
+import orjson
 from control import move_location, move_down, move_left, move_right, move_up
 import threading
 
@@ -26,10 +26,18 @@ MOVE_REL_RIGHT = "right"
 MOVE_REL_UP = "up"
 MOVE_REL_DOWN = "down"
 
+# paho's reconnect backoff is 1, 2, 4... seconds capped at MAX_RECONNECT_DELAY,
+# we give up (and exit) after MAX_RECONNECT_FAILURES failures in a row
+MAX_RECONNECT_DELAY = 60
+MAX_RECONNECT_FAILURES = 20
+
 
 
 ha_reregister_event = threading.Event()
-mqtt_shutdown_event = threading.Event()
+
+# client created by start_mqtt, kept so stop_mqtt can disconnect it
+active_client: mqtt_client.Client = None
+reconnect_failures = 0
 
 
 @dataclass
@@ -38,19 +46,15 @@ class MqttMessage:
     argument: str
 
 
+MOVE_REL_HANDLERS = {
+    (COMMAND_MOVE_REL, MOVE_REL_UP): move_up,
+    (COMMAND_MOVE_REL, MOVE_REL_DOWN): move_down,
+    (COMMAND_MOVE_REL, MOVE_REL_LEFT): move_left,
+    (COMMAND_MOVE_REL, MOVE_REL_RIGHT): move_right,
+}
 
-logger = logging.getLogger(__name__)
 
-def worker():
-    while True:
-        # wait until signaled
-        ha_reregister_event.wait()
-        ha_reregister_event.clear()  # reset the flag
-        print("Re-registering with Home Assistant...")
-        homeassistant_register()
-        # call your actual re-registration function here
-        # e.g., re_register_ha()
-        time.sleep(0.1)  # optional: prevent busy looping
+logger = logging.getLogger(__name__)
 
 #
 # MQTT callbacks
@@ -61,30 +65,34 @@ def on_message(client, userdata, msg):
     # print(msg.topic+" "+str(msg.payload))
     data = None
     try:
-        data = json.loads(msg.payload)
-    except json.JSONDecodeError as e:
+        data = orjson.loads(msg.payload)
+    except orjson.JSONDecodeError as e:
         logger.error(f"invalid JSON: {e} payload={msg.payload}")
         return
-    
-    mqttMessage = MqttMessage(**data)
-    if mqttMessage.command == COMMAND_MOVE_REL and mqttMessage.argument == MOVE_REL_UP:
-        move_up()
-    elif mqttMessage.command == COMMAND_MOVE_REL and mqttMessage.argument == MOVE_REL_DOWN:
-        move_down()
-    elif mqttMessage.command == COMMAND_MOVE_REL and mqttMessage.argument == MOVE_REL_LEFT:
-        move_left()
-    elif mqttMessage.command == COMMAND_MOVE_REL and mqttMessage.argument == MOVE_REL_RIGHT:
-        move_right()
-    elif mqttMessage.command == COMMAND_LOCATION:
-        move_location(mqttMessage.argument)
+
+    if not isinstance(data, dict):
+        logger.error(f"invalid message: payload={msg.payload}")
+        return
+
+    command = data.get("command")
+    argument = data.get("argument")
+    handler = MOVE_REL_HANDLERS.get((command, argument))
+    if handler:
+        handler()
+    elif command == COMMAND_LOCATION:
+        move_location(argument)
     else:
-        logger.error(f"invalid command={mqttMessage.command}")
+        logger.error(f"invalid command={command}")
         
 
 def on_connect(client, userdata, flags, rc, properties):
+    global reconnect_failures
     logger.info("on_connect")
     if rc == 0:
         logger.info("Connected to MQTT Broker!")
+        reconnect_failures = 0
+        # (re-)register with home assistant from start_mqtt's loop, not this callback
+        ha_reregister_event.set()
     else:
         logger.error("Failed to connect, return code %d\n", rc)
 
@@ -101,23 +109,66 @@ def on_subscribe(s, userdata, mid, reasoncodes, properties):
 def on_disconnect(client, userdata, flags, rc, properties=None):
     logger.debug("on_disconnect")
     logger.info("Disconnected with result code: %s", rc)
-    reconnect_delay = 10
-    while True:
-        logging.info("Reconnecting in %d seconds...", reconnect_delay)
-        time.sleep(reconnect_delay)
+    # paho's loop_start() thread reconnects by itself (see reconnect_delay_set
+    # in start_mqtt) - never block or reconnect from in here
 
-        try:
-            client.reconnect()
-            logging.info("Reconnected successfully!?")
-            return
-        except Exception as err:
-            logging.error("%s. Reconnect failed. Retrying...", err)
+def on_connect_fail(client, userdata):
+    global reconnect_failures
+    reconnect_failures += 1
+    logger.error(f"MQTT connect failed ({reconnect_failures}/{MAX_RECONNECT_FAILURES})")
+    if reconnect_failures >= MAX_RECONNECT_FAILURES:
+        # let the service manager restart us from scratch
+        shutdown_thread(f"MQTT reconnect failed {reconnect_failures} times")
 
 
 def get_device_command_topic():
     config = get_config()
     return f"{config.mqtt.command_base_topic}/{config.mqtt.client_id}/command"
 
+# HA registration payloads only depend on config, which is loaded after import
+# so build them on first use
+ha_device = None
+ha_direction_registrations = None
+
+def get_ha_device():
+    global ha_device
+    if not ha_device:
+        config = get_config()
+        ha_device = {
+            "identifiers": [
+                config.mqtt.client_id
+            ],
+            "configuration_url": f"http://{config.mqtt.client_id}:{config.pitilt.port}",
+            "name": config.mqtt.client_id,
+            "sw_version": f"{APP_NAME} {VERSION}",
+            "model": f"{APP_NAME} Version {VERSION} API {API_VERSION}",
+            "manufacturer": "Geoff Williams"
+        }
+    return ha_device
+
+def ha_registration(name, object_id, payload: MqttMessage):
+    return orjson.dumps({
+        "name": name,
+        "unique_id": f"pitilt_{get_config().mqtt.client_id}_{object_id}",
+        "payload_press": orjson.dumps(asdict(payload)).decode(),
+        "command_topic": get_device_command_topic(),
+        "qos": 2,
+        "device": get_ha_device()
+    })
+
+def get_ha_direction_registrations():
+    global ha_direction_registrations
+    if not ha_direction_registrations:
+        ha_direction_registrations = {
+            direction: ha_registration(
+                f"Move {direction}",
+                f"move_{direction}",
+                MqttMessage(COMMAND_MOVE_REL, direction)
+            )
+            for direction in [MOVE_REL_LEFT, MOVE_REL_RIGHT, MOVE_REL_UP, MOVE_REL_DOWN]
+        }
+    return ha_direction_registrations
+
 # best docs: https://stevessmarthomeguide.com/adding-an-mqtt-device-to-home-assistant/
 # <discovery_prefix>/<component>/[<node_id>/]<object_id>/config
 # eg
@@ -131,73 +182,40 @@ def homeassistant_register(client):
     # register a subset of commands as MQTT commands
 
     #
-    # move_rel
+    # move_rel - fixed for the life of the process
     # 
-    for direction in [MOVE_REL_LEFT, MOVE_REL_RIGHT, MOVE_REL_UP, MOVE_REL_DOWN]:
-        payload = MqttMessage(COMMAND_MOVE_REL, direction)
-        payload_str = json.dumps(asdict(payload))
-        registration = {
-            "name": f"Move {direction}",
-            "unique_id": f"pitilt_{config.mqtt.client_id}_move_{direction}",
-            "payload_press": payload_str,
-            "command_topic": get_device_command_topic(),
-            "qos": 2,
-            "device": {
-                "identifiers": [
-                    config.mqtt.client_id
-                ],
-                "configuration_url": f"http://{config.mqtt.client_id}:{config.pitilt.port}",
-                "name": config.mqtt.client_id,
-                "sw_version": f"{APP_NAME} {VERSION}",
-                "model": f"{APP_NAME} Version {VERSION} API {API_VERSION}",
-                "manufacturer": "Geoff Williams"
-            }
-        }
+    for direction, registration in get_ha_direction_registrations().items():
         ha_topic = f"{ha_base_topic}/{direction}/config"
-        registration_str = json.dumps(registration)
-        logger.info(f"register homeassistant device: topic={ha_topic}\n{registration_str}")
-        client.publish(ha_topic, registration_str, 1, retain=True)
+        logger.info(f"register homeassistant device: topic={ha_topic}\n{registration.decode()}")
+        client.publish(ha_topic, registration, 1, retain=True)
 
     #
     # location
     #
     for location_name in get_state().locations.keys():
-        payload = MqttMessage(COMMAND_LOCATION, location_name)
-        payload_str = json.dumps(asdict(payload))
-        registration = {
-            "name": f"Location: {location_name}",
-            "unique_id": f"pitilt_{config.mqtt.client_id}_location_{location_name}",
-            "payload_press": payload_str,
-            "command_topic": get_device_command_topic(),
-            "qos": 2,
-            "device": {
-                "identifiers": [
-                    config.mqtt.client_id
-                ],
-                "configuration_url": f"http://{config.mqtt.client_id}:{config.pitilt.port}",
-                "name": config.mqtt.client_id,
-                "sw_version": f"{APP_NAME} {VERSION}",
-                "model": f"{APP_NAME} Version {VERSION} API {API_VERSION}",
-                "manufacturer": "Geoff Williams"
-            }
-        }
+        registration = ha_registration(
+            f"Location: {location_name}",
+            f"location_{location_name}",
+            MqttMessage(COMMAND_LOCATION, location_name)
+        )
         ha_topic = f"{ha_base_topic}/location_{location_name}/config"
-        registration_str = json.dumps(registration)
-        logger.info(f"register homeassistant device: topic={ha_topic}\n{registration_str}")
-        client.publish(ha_topic, registration_str, 1, retain=True)
+        logger.info(f"register homeassistant device: topic={ha_topic}\n{registration.decode()}")
+        client.publish(ha_topic, registration, 1, retain=True)
 
 #
 # MQTT client config
 #
 
 def start_mqtt():
+    global active_client
     config = get_config()
     if not config.mqtt.mqtt_enabled:
         logger.info("mqtt disabled in config file")
+        return
 
     logger.info("configuring MQTT...")
 
-    client = mqtt_client.Client(
+    client = active_client = mqtt_client.Client(
         client_id=config.mqtt.client_id,
         transport=config.mqtt.transport,
         protocol=mqtt_client.MQTTv5
@@ -265,6 +283,8 @@ def start_mqtt():
     client.on_publish = on_publish
     client.on_subscribe = on_subscribe
     client.on_disconnect = on_disconnect
+    client.on_connect_fail = on_connect_fail
+    client.reconnect_delay_set(min_delay=1, max_delay=MAX_RECONNECT_DELAY)
 
     properties=Properties(PacketTypes.CONNECT)
     properties.SessionExpiryInterval=30*60 # in seconds
@@ -272,24 +292,23 @@ def start_mqtt():
     #
     # Connect...
     #
+    # async so the first connection goes through paho's reconnect backoff (and
+    # on_connect_fail) too, rather than an exception here ending the thread
     logger.info(f"connecting to {config.mqtt.host}")
-    client.connect(
+    client.connect_async(
         config.mqtt.host, 
         port=config.mqtt.port,
         #clean_start=MQTT_CLEAN_START_FIRST_ONLY,
         #properties=properties,
         keepalive=60
     )
-    # client.loop_start()
-    logger.info("connected???")
-    # client.loop_start()
 
     # QOS - for your reference
     # At most once (QoS 0): QoS 0 offers "fire and forget" messaging with no acknowledgment from the receiver.
     # At least once (QoS 1): QoS 1 ensures that messages are delivered at least once by requiring a PUBACK acknowledgment.
     # Exactly once (QoS 2): QoS 2 guarantees that each message is delivered exactly once by using a four-step handshake (PUBLISH, PUBREC, PUBREL, PUBCOMP). 
 
-    homeassistant_register(client)
+    # homeassistant_register runs from the loop below once on_connect fires
     # client.subscribe(get_device_command_topic())
 
     # #,0,properties=properties)
@@ -306,19 +325,20 @@ def start_mqtt():
     # client.loop_forever()
     # client.loop_forever()
     client.loop_start()
-    while True:
+    while not shutdown_event.is_set():
         # wait until signaled
         ha_reregister_event.wait()
         ha_reregister_event.clear()  # reset the flag
-        print("Re-registering with Home Assistant...")
+        if shutdown_event.is_set():
+            break
+        logger.info("Re-registering with Home Assistant...")
         homeassistant_register(client)
-        # call your actual re-registration function here
-        # e.g., re_register_ha()
         time.sleep(0.1)  # optional: prevent busy looping
 
 
-
-
-def shutdown_thread(msg):
-    logger.error(msg)
-    mqtt_shutdown_event.set()
+def stop_mqtt():
+    # wake the re-register loop so start_mqtt returns
+    ha_reregister_event.set()
+    if active_client:
+        active_client.disconnect()
+        active_client.loop_stop()
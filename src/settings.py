@@ -1,8 +1,13 @@
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
 from typing import Dict
 import socket
 import yaml
 import json
+import sqlite3
+import hashlib
+import hmac
+import time
+import threading
 import logging
 from logging.config import dictConfig
 import sys
@@ -10,9 +15,11 @@ from constants import (
     LOG_CONFIG,
     DEFAULT_CONFIG_FILE,
     DEFAULT_STATE_FILE,
+    DEFAULT_STATE_DB,
     DEFAULT_SERVO_SLEEP,
     DEFAULT_SERVO_STEP,
-    AUTH_METHOD_PASSWORD
+    AUTH_METHOD_PASSWORD,
+    SAVE_STATE_DEBOUNCE
 )
 from pathlib import Path
 from dacite import from_dict
@@ -54,6 +61,10 @@ class PitiltConfig:
     port: int = 8000
     debug: bool = False
     uvicorn_log_level = "info"
+    # seconds a /login session cookie stays valid
+    session_max_age: int = 12 * 60 * 60
+    # another process writes the state database too - pick up its changes
+    shared_state: bool = False
 
 
 @dataclass
@@ -63,7 +74,7 @@ class Config:
 
 
 #
-# JSON - managed state (locations, servo limits)
+# SQLite - managed state (locations, servo limits)
 #
 @dataclass
 class ServoPosition:
@@ -97,6 +108,19 @@ class State:
 logger = logging.getLogger(__name__)
 log_config = None
 config: Config = None
+auth_digest: bytes = None
+session_key: bytes = None
+save_timer: threading.Timer = None
+# set by any thread that needs the whole app to exit
+shutdown_event = threading.Event()
+# guards state/db across the API, MQTT and save timer threads
+state_lock = threading.RLock()
+db: sqlite3.Connection = None
+db_data_version: int = None
+# (axis, field) changed since the last write_state()
+dirty_position = set()
+# copy of config.pitilt.shared_state, get_state() is called a lot
+shared_state = False
 state: State = State(
     position=Position(
         pan=ServoPosition(
@@ -129,42 +153,172 @@ def setup_logging():
 
 
 
-def load_state():
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS position (
+    axis TEXT PRIMARY KEY,
+    min INTEGER NOT NULL,
+    max INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    sleep REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS locations (
+    name TEXT PRIMARY KEY,
+    pan INTEGER NOT NULL,
+    tilt INTEGER NOT NULL
+);
+"""
+# ServoPosition fields/position table columns
+POSITION_FIELDS = ("min", "max", "step", "sleep")
+
+def get_db():
+    global db
+    if not db:
+        state_db = get_state_db_path()
+        if not state_db.exists():
+            logger.info(f"state database does not exist, creating: {state_db}")
+        # autocommit - transactions are opened explicitly where needed. One
+        # connection is shared by all threads, serialized by state_lock
+        db = sqlite3.connect(state_db, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(STATE_SCHEMA)
+    return db
+
+def get_db_data_version():
+    # changes whenever *another* connection (eg another worker process) commits
+    return get_db().execute("PRAGMA data_version").fetchone()[0]
+
+def read_state_db():
+    global state, db_data_version
+    positions = {
+        axis: ServoPosition(*limits)
+        for axis, *limits in get_db().execute("SELECT axis, min, max, step, sleep FROM position")
+    }
+    locations = {
+        name: Location(pan=pan, tilt=tilt)
+        for name, pan, tilt in get_db().execute("SELECT name, pan, tilt FROM locations")
+    }
+    state = State(
+        position=Position(pan=positions["pan"], tilt=positions["tilt"]),
+        locations=locations
+    )
+    db_data_version = get_db_data_version()
+
+def read_state_file(state_file):
+    """legacy JSON state file, imported once into the state database"""
     global state
 
-    state_file = get_state_file_path()
-    if state_file.exists():
-
-        with open(state_file, "r") as f:
-            data = json.load(f)
-
-        try:
-            state = State(
-                position=Position(
-                    pan=ServoPosition(**data["position"]["pan"]),
-                    tilt=ServoPosition(**data["position"]["tilt"])
-                ),
-                locations={name: Location(**loc) for name, loc in data["locations"].items()}
-            )
-            logger.debug(f"loaded: {state_file}")
-        except TypeError as e:
-            sys.exit(f"{state_file} bad. Delete/fix it, then try again: {e}")
-    else:
-        # file no exist, create the defaults
-        save_state()
+    with open(state_file, "r") as f:
+        data = json.load(f)
+
+    try:
+        state = State(
+            position=Position(
+                pan=ServoPosition(**data["position"]["pan"]),
+                tilt=ServoPosition(**data["position"]["tilt"])
+            ),
+            locations={name: Location(**loc) for name, loc in data["locations"].items()}
+        )
+        logger.debug(f"loaded: {state_file}")
+    except TypeError as e:
+        sys.exit(f"{state_file} bad. Delete/fix it, then try again: {e}")
+
+def load_state():
+    global db_data_version
+    with state_lock, get_db():
+        # take the write lock before looking so two processes starting together
+        # can't both import, and the import lands all at once or not at all
+        get_db().execute("BEGIN IMMEDIATE")
+        if get_db().execute("SELECT COUNT(*) FROM position").fetchone()[0]:
+            read_state_db()
+            logger.debug(f"loaded: {get_state_db_path()}")
+            return
+
+        state_file = get_state_file_path()
+        if state_file.exists():
+            logger.info(f"importing {state_file} into {get_state_db_path()}")
+            read_state_file(state_file)
+        # else: database is new, create the defaults
+
+        get_db().executemany(
+            "INSERT INTO position (axis, min, max, step, sleep) VALUES (?, ?, ?, ?, ?)",
+            [
+                (axis, p.min, p.max, p.step, p.sleep)
+                for axis, p in (("pan", state.position.pan), ("tilt", state.position.tilt))
+            ]
+        )
+        get_db().executemany(
+            "INSERT INTO locations (name, pan, tilt) VALUES (?, ?, ?)",
+            [(name, location.pan, location.tilt) for name, location in state.locations.items()]
+        )
+        db_data_version = get_db_data_version()
 
 def save_state():
-    logger.debug(f"locations in state: {','.join(state.locations.keys())}")
-    state_file = get_state_file_path()
-    if not state_file.exists():
-        logger.info(f"state file does not exist, creating: {state_file}")
+    """schedule a state write, restarting the debounce timer if one is pending"""
+    global save_timer
+    with state_lock:
+        if save_timer:
+            save_timer.cancel()
+        save_timer = threading.Timer(SAVE_STATE_DEBOUNCE, write_state)
+        save_timer.daemon = True
+        save_timer.start()
+
+def flush_state():
+    """write any pending state change now (shutdown)"""
+    with state_lock:
+        if save_timer:
+            save_timer.cancel()
+        if dirty_position:
+            write_state()
+
+def write_state():
+    """write the servo limits/settings changed by set_position - locations are
+    written by set_location/remove_location"""
+    global db_data_version
+    with state_lock:
+        if not dirty_position:
+            # already flushed
+            return
+        with get_db():
+            get_db().execute("BEGIN")
+            for axis, name in dirty_position:
+                # only the changed column, the rest of the row may have been
+                # changed by another process. name is from POSITION_FIELDS
+                get_db().execute(
+                    f"UPDATE position SET {name} = ? WHERE axis = ?",
+                    (getattr(getattr(state.position, axis), name), axis)
+                )
+        dirty_position.clear()
+        db_data_version = get_db_data_version()
+        logger.debug(f"saved {get_state_db_path()}")
+
+def set_position(axis, name, value):
+    """set one servo limit/setting (eg "tilt", "max") and schedule saving it"""
+    if name not in POSITION_FIELDS:
+        raise ValueError(f"no such servo setting: {name}")
+    with state_lock:
+        setattr(getattr(get_state().position, axis), name, value)
+        dirty_position.add((axis, name))
+        save_state()
 
-    with open(state_file, "w", encoding="utf-8") as f:
-        json.dump(asdict(state), f, indent=2)
-        logger.debug(f"saved {state_file}")
+def set_location(name, location: Location):
+    with state_lock:
+        get_state().locations[name] = location
+        get_db().execute(
+            "INSERT OR REPLACE INTO locations (name, pan, tilt) VALUES (?, ?, ?)",
+            (name, location.pan, location.tilt)
+        )
+        logger.debug(f"locations in state: {','.join(state.locations.keys())}")
+
+def remove_location(name):
+    with state_lock:
+        # KeyError for unknown location
+        del get_state().locations[name]
+        get_db().execute("DELETE FROM locations WHERE name = ?", (name,))
+        logger.debug(f"locations in state: {','.join(state.locations.keys())}")
 
 def load_config():
-    global config
+    global config, shared_state
     config_file = get_config_file_path()
 
     if not config_file.exists():
@@ -174,6 +328,46 @@ def load_config():
         data = yaml.safe_load(f)
         config = from_dict(data_class=Config, data=data)
 
+    shared_state = config.pitilt.shared_state
+    set_auth()
+
+def credentials_digest(username: str, password: str):
+    return hashlib.sha256(username.encode() + b"\0" + password.encode()).digest()
+
+def set_auth():
+    global auth_digest, session_key
+    if config.pitilt.password:
+        auth_digest = credentials_digest(config.pitilt.username, config.pitilt.password)
+        # derived from the password so changing it invalidates existing sessions
+        session_key = hmac.new(config.pitilt.password.encode(), b"pitilt session", hashlib.sha256).digest()
+    else:
+        # no password configured - nothing can match
+        logger.error("no pitilt.password set in config file - API logins will fail")
+        auth_digest = b""
+        session_key = None
+
+def sign_session(issued: str):
+    return hmac.new(
+        session_key,
+        f"{config.pitilt.username}:{issued}".encode(),
+        hashlib.sha256
+    ).hexdigest()
+
+def make_session_token():
+    """session cookie value: <issued at>.<signature>"""
+    issued = str(int(time.time()))
+    return f"{issued}.{sign_session(issued)}"
+
+def valid_session_token(token: str):
+    if not session_key:
+        return False
+    issued, _, signature = token.partition(".")
+    if not (issued.isascii() and issued.isdigit()):
+        return False
+    if not hmac.compare_digest(signature.encode(), sign_session(issued).encode()):
+        return False
+    return 0 <= time.time() - int(issued) <= config.pitilt.session_max_age
+
 
 def setup():
     """load config and state"""
@@ -187,11 +381,30 @@ def setup():
 def get_config():
     return config
 
+def shutdown_thread(msg):
+    """called from any thread to stop the app"""
+    logger.error(msg)
+    shutdown_event.set()
+
+def get_auth_digest():
+    return auth_digest
+
 def get_state():
-    return state
+    if not shared_state:
+        # only this process writes the database, memory is always current
+        return state
+
+    with state_lock:
+        if db and get_db_data_version() != db_data_version:
+            logger.info("state changed by another process, reloading")
+            # write our pending debounced change first or the reload drops it
+            flush_state()
+            read_state_db()
+        return state
 
 config_file=None
 state_file=None
+state_db=None
 
 def get_config_file_path():
     global config_file
@@ -208,4 +421,11 @@ def get_state_file_path():
         logger.info(f"Using state_file={state_file}")
 
     return state_file
-    
\ No newline at end of file
+
+def get_state_db_path():
+    global state_db
+    if not state_db:
+        state_db = Path(os.environ.get("PITILT_STATE_DB", DEFAULT_STATE_DB))
+        logger.info(f"Using state_db={state_db}")
+
+    return state_db